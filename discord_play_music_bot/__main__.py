@@ -12,12 +12,18 @@ pip install -U discord.py pynacl youtube-dl
 """
 
 import asyncio
+import contextlib
+import datetime
 import functools
 import itertools
+import json
 import math
 import os
 import random
+import threading
+import time
 
+import aiohttp
 import discord
 import youtube_dl
 from async_timeout import timeout
@@ -35,6 +41,428 @@ class YTDLError(Exception):
     pass
 
 
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(
+        self, name: str, parent_id: str = None, start: int = None, **attributes
+    ):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def seconds(self):
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_otlp(self, trace_id: str):
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": k, "value": {"stringValue": str(v)}}
+                for k, v in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class PlayTrace:
+    """!play 1回分のスパンツリーです。
+    最初のOpusフレームが送出された時点でルートスパンを閉じ、time-to-first-audioとして書き出します。
+    """
+
+    def __init__(self, tracer: "Tracer", ctx: commands.Context):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.finished = False
+        self._loop = ctx.bot.loop
+
+        now = time.time_ns()
+        # Discord側でメッセージが作られた時刻から計測する (時計のずれで未来にならないよう丸める)
+        created_at = getattr(ctx.message, "created_at", None)
+        if created_at:
+            created = created_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+            start = min(int(created * 1e9), now)
+        else:
+            start = now
+
+        self.root = Span("play", start=start, guild=ctx.guild.id)
+        self.spans = [self.root, Span("dispatch", self.root.span_id, start=start)]
+        self.spans[-1].end = now
+        self._stack = [self.root]
+        self._queue_wait = None
+        self.first_audio = None
+
+    def start_span(self, name: str, **attributes):
+        span = Span(name, self._stack[-1].span_id, **attributes)
+        self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        span = self.start_span(name, **attributes)
+        self._stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e)
+            raise
+        finally:
+            self._stack.remove(span)
+            span.end = time.time_ns()
+
+    def queued(self):
+        self._queue_wait = self.start_span("queue_wait")
+
+    def dequeued(self):
+        if self._queue_wait:
+            self._queue_wait.end = time.time_ns()
+        self.start_span("first_frame")
+
+    def first_frame(self):
+        # プレイヤースレッドから呼ばれるので、イベントループ側で閉じる
+        self.first_audio = time.time_ns()
+        self._loop.call_soon_threadsafe(self.finish, None, self.first_audio)
+
+    def drop(self, reason: str):
+        """最初のフレームを送る前に曲が取り消された場合、エラーとして閉じます。"""
+        if self.first_audio is None:
+            self.finish(VoiceError(reason))
+
+    def finish(self, error: Exception = None, end: int = None):
+        if self.finished:
+            return
+        self.finished = True
+
+        end = end or time.time_ns()
+        for span in self.spans:
+            if span.end is None:
+                span.end = end
+        if error:
+            self.root.error = str(error)
+        else:
+            self.root.attributes["time_to_first_audio_ms"] = round(
+                self.root.seconds * 1000
+            )
+
+        self.tracer.export(self)
+
+    def summary(self):
+        stages = ", ".join(
+            "{} {:.2f}s".format(s.name, s.seconds) for s in self.spans[1:]
+        )
+        if self.root.error:
+            return "[trace {}] 失敗 ({}) | {}".format(
+                self.trace_id[:8], self.root.error, stages
+            )
+        return "[trace {}] time-to-first-audio {:.2f}s | {}".format(
+            self.trace_id[:8], self.root.seconds, stages
+        )
+
+    def to_otlp(self):
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "discord-play-music-bot"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "discord_play_music_bot"},
+                            "spans": [s.to_otlp(self.trace_id) for s in self.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+def trace_span(trace: PlayTrace, name: str, **attributes):
+    """traceがNoneなら何もしないスパンを返します。"""
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name, **attributes)
+
+
+class FileSpanExporter:
+    """1トレースを1行のOTLP/JSONとしてファイルに追記します。
+    イベントループを止めないよう、書き込みはexecutorで行います。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def export(self, trace: PlayTrace):
+        line = json.dumps(trace.to_otlp()) + "\n"
+        future = trace._loop.run_in_executor(None, self._write, line)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    def _write(self, line: str):
+        # 複数のスレッドから書いても行が混ざらないようにする
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    async def close(self):
+        await asyncio.gather(*self._pending, return_exceptions=True)
+
+
+class OTLPSpanExporter:
+    """OTLP/HTTP (JSON) のコレクタへトレースを送信します。
+    セッションは最初の送信時に作り、closeするまで使い回します。
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._session = None
+        self._pending = set()
+
+    def export(self, trace: PlayTrace):
+        task = trace._loop.create_task(self._post(trace.to_otlp()))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _post(self, payload: dict):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        try:
+            async with self._session.post(self.endpoint, json=payload) as resp:
+                resp.raise_for_status()
+        except (aiohttp.ClientError, OSError) as e:
+            print("トレースの送信に失敗しました: {}".format(e))
+
+    async def close(self):
+        """送信中のトレースを待ってから、セッションを閉じます。"""
+        await asyncio.gather(*self._pending, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class Tracer:
+    """!play のトレースを作成し、設定されたエクスポーターへ書き出します。
+    環境変数 TRACE_FILE / OTLP_ENDPOINT で書き出し先を指定できます。
+    """
+
+    def __init__(self, exporters: list = None):
+        self.exporters = exporters or []
+
+    @classmethod
+    def from_env(cls):
+        exporters = []
+        if os.environ.get("TRACE_FILE"):
+            exporters.append(FileSpanExporter(os.environ["TRACE_FILE"]))
+        if os.environ.get("OTLP_ENDPOINT"):
+            exporters.append(OTLPSpanExporter(os.environ["OTLP_ENDPOINT"]))
+        return cls(exporters)
+
+    def start_play(self, ctx: commands.Context):
+        return PlayTrace(self, ctx)
+
+    def export(self, trace: PlayTrace):
+        print(trace.summary())
+        for exporter in self.exporters:
+            exporter.export(trace)
+
+    async def close(self):
+        for exporter in self.exporters:
+            await exporter.close()
+
+
+class FrameRing:
+    """固定長フレームを保持する、事前確保したリングバッファです。
+    書き込み側 (読み込みスレッド) だけがブロックし、読み出し側は決してブロックしません。
+    """
+
+    def __init__(self, depth: int, frame_size: int):
+        if depth < 1:
+            raise ValueError("depth must be at least 1, got {}".format(depth))
+        self.depth = depth
+        self.frame_size = frame_size
+        self._view = memoryview(bytearray(depth * frame_size))
+        self._head = 0
+        self._count = 0
+        self._cond = threading.Condition()
+        self.eof = False
+        self.closed = False
+        self._on_filled = []
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def filled(self):
+        """満杯か、ストリームが終わったか、閉じられていればTrueです。"""
+        return self._count == self.depth or self.eof or self.closed
+
+    def when_filled(self, callback):
+        """filledになったときにcallbackを1回呼びます。すでにfilledならすぐに呼びます。
+        callbackは書き込み側のスレッドから呼ばれることがあります。
+        """
+        with self._cond:
+            if not self.filled:
+                self._on_filled.append(callback)
+                return
+        callback()
+
+    def cancel_when_filled(self, callback):
+        with self._cond:
+            if callback in self._on_filled:
+                self._on_filled.remove(callback)
+
+    def _notify(self):
+        self._cond.notify_all()
+        if self.filled and self._on_filled:
+            callbacks, self._on_filled = self._on_filled, []
+            for callback in callbacks:
+                callback()
+
+    def put(self, data: bytes):
+        """空きができるまで待って1フレーム書き込みます。閉じられていればFalseを返します。"""
+        with self._cond:
+            while self._count == self.depth and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return False
+
+            start = (self._head + self._count) % self.depth * self.frame_size
+            self._view[start : start + self.frame_size] = data
+            self._count += 1
+            self._notify()
+            return True
+
+    def get(self):
+        """1フレーム取り出します。空ならNoneを返します。"""
+        with self._cond:
+            if self._count == 0:
+                return None
+
+            start = self._head * self.frame_size
+            data = bytes(self._view[start : start + self.frame_size])
+            self._head = (self._head + 1) % self.depth
+            self._count -= 1
+            self._cond.notify_all()
+            return data
+
+    def finish(self):
+        with self._cond:
+            self.eof = True
+            self._notify()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._notify()
+
+
+class BufferedAudio(discord.AudioSource):
+    """ffmpegからの読み込みを別スレッドで先行させるジッタバッファです。
+    プレイヤースレッドはバッファから取り出すだけなので、ffmpegやネットワークの停滞で止まりません。
+    バッファが空のときは無音フレームを返し、underrunsに数えます。
+    バッファが埋まるのを待つprimeは、再生前にイベントループ上でawaitしてください。
+    """
+
+    FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+    SILENCE = bytes(FRAME_SIZE)
+    # 再生開始時にバッファが埋まるのを待つ最大秒数
+    PRIME_TIMEOUT = 5.0
+    # 解放後に無音で応える最大フレーム数。中断と競合した読み出しだけを吸収する
+    RELEASED_SILENCE_FRAMES = 5
+
+    def __init__(self, source: discord.AudioSource, *, depth: int):
+        self.source = source
+        self.ring = FrameRing(depth, self.FRAME_SIZE)
+        self.frames = 0
+        self.underruns = 0
+        self._released_reads = 0
+
+        # スレッドにselfを渡さないことで、再生されずに捨てられた場合もGCでcleanupされる
+        self._reader = threading.Thread(
+            target=self._fill, args=(source, self.ring), daemon=True
+        )
+        self._reader.start()
+
+    @staticmethod
+    def _fill(source: discord.AudioSource, ring: FrameRing):
+        try:
+            while not ring.closed:
+                data = source.read()
+                if len(data) != ring.frame_size or not ring.put(data):
+                    break
+        except Exception:
+            # cleanupでffmpegが終了させられた場合など
+            pass
+        finally:
+            ring.finish()
+
+    async def prime(self, loop: asyncio.AbstractEventLoop = None):
+        """バッファが埋まるか、ストリームが終わるまで待ちます。埋まればTrueを返します。
+        読み込みスレッドからの通知を待つので、executorのスレッドを占有しません。
+        """
+        loop = loop or asyncio.get_event_loop()
+        filled = loop.create_future()
+
+        def resolve():
+            if not filled.done():
+                filled.set_result(True)
+
+        def notify():
+            loop.call_soon_threadsafe(resolve)
+
+        self.ring.when_filled(notify)
+        try:
+            return await asyncio.wait_for(filled, self.PRIME_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.ring.cancel_when_filled(notify)
+
+    def read(self):
+        data = self.ring.get()
+        if data is None:
+            if self.ring.closed:
+                # 再生中に解放された場合、競合した数フレームは無音で返してプレイヤーを止めない。
+                # それ以上読まれ続けるなら、曲を終わらせる
+                if self._released_reads < self.RELEASED_SILENCE_FRAMES:
+                    self._released_reads += 1
+                    return self.SILENCE
+                return b""
+            if self.ring.eof:
+                return b""
+            self.underruns += 1
+            data = self.SILENCE
+
+        self.frames += 1
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.ring.close()
+        self.source.cleanup()
+
+
 class YTDLSource(discord.PCMVolumeTransformer):
     YTDL_OPTIONS = {
         "format": "bestaudio/best",
@@ -57,18 +485,23 @@ class YTDLSource(discord.PCMVolumeTransformer):
         "options": "-vn",
     }
 
+    # ジッタバッファの深さ (1フレーム20ms、最低1フレーム)
+    BUFFER_FRAMES = max(1, int(os.environ.get("JITTER_BUFFER_FRAMES", 25)))
+
     ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
 
     def __init__(
         self,
         ctx: commands.Context,
-        source: discord.FFmpegPCMAudio,
+        source: BufferedAudio,
         *,
         data: dict,
         volume: float = 0.5,
+        start: float = 0,
     ):
         super().__init__(source, volume)
 
+        self._ctx = ctx
         self.requester = ctx.author
         self.channel = ctx.channel
         self.data = data
@@ -87,13 +520,114 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.likes = data.get("like_count")
         self.dislikes = data.get("dislike_count")
         self.stream_url = data.get("url")
+        self.format_id = data.get("format_id")
+        self.abr = data.get("abr") or data.get("tbr")
+        self.channel_bitrate = data.get("channel_bitrate")
+        self.bestaudio_abr = data.get("bestaudio_abr")
+        self.trace = None
+        self.frames = 0
+        self.start = start
+
+    @property
+    def position(self):
+        """再生済みの位置 (秒) です。無音で埋めたフレームは含みません。"""
+        return self.start + self.frames * 0.02
+
+    @property
+    def released(self):
+        """cleanupでffmpegとストリームが解放されていればTrueです。"""
+        return self.original.ring.closed
+
+    async def prime(self, loop: asyncio.AbstractEventLoop = None):
+        """再生前に、ジッタバッファが埋まるのを待ちます。"""
+        return await self.original.prime(loop)
+
+    def seek(self, position: float):
+        """同じストリームをposition秒の位置から再生する新しいソースを返します。"""
+        options = dict(self.FFMPEG_OPTIONS)
+        options["before_options"] += " -ss {:.2f}".format(position)
+        source = BufferedAudio(
+            discord.FFmpegPCMAudio(self.stream_url, **options),
+            depth=self.BUFFER_FRAMES,
+        )
+        new = type(self)(
+            self._ctx, source, data=self.data, volume=self.volume, start=position
+        )
+        # 最初のフレームより前に中断された場合は、トレースを引き継ぐ
+        new.trace, self.trace = self.trace, None
+        return new
+
+    def read(self):
+        frames, underruns = self.original.frames, self.original.underruns
+        data = super().read()
+        # 無音で埋めたフレームは数えず、最初の実フレームが読めたらトレースを閉じる
+        if self.original.frames > frames and self.original.underruns == underruns:
+            self.frames += 1
+            if self.trace:
+                trace, self.trace = self.trace, None
+                trace.first_frame()
+        return data
+
+    def cleanup(self):
+        # ffmpegを終了させる前に、デコードに使ったCPU時間を取得する
+        process = self.original.source._process
+        if process is None:
+            return super().cleanup()
+
+        cpu = self.process_cpu_seconds(process.pid)
+        super().cleanup()
+        # 再生されずに捨てられた曲は報告しない
+        if self.frames > 0:
+            print(self.fetch_report(cpu))
+
+    @staticmethod
+    def process_cpu_seconds(pid: int):
+        """プロセスのCPU時間 (user + system) を返します。Linux以外ではNoneを返します。"""
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def estimated_bytes(self, abr: float):
+        """再生した長さとビットレートから、取得したバイト数を見積もります。
+        比較できるよう、選んだフォーマットとbestaudioで同じ計算を使います。
+        """
+        return int(abr * 1000 / 8 * self.frames * 0.02)
+
+    def fetch_report(self, cpu: float = None):
+        report = "[fetch] {} format={} ({} kbps, channel {} kbps) {:.0f}s".format(
+            self.title,
+            self.format_id,
+            self.abr,
+            self.channel_bitrate and self.channel_bitrate // 1000,
+            self.frames * 0.02,
+        )
+        if self.abr:
+            report += " ~{} bytes".format(self.estimated_bytes(self.abr))
+        if self.bestaudio_abr and self.abr:
+            report += " (bestaudio {} kbps: ~{} bytes)".format(
+                self.bestaudio_abr, self.estimated_bytes(self.bestaudio_abr)
+            )
+        if cpu is not None:
+            report += " ffmpeg cpu {:.2f}s".format(cpu)
+        report += " underruns {}/{}".format(
+            self.original.underruns, self.original.frames
+        )
+        return report
 
     def __str__(self):
         return "**{0.title}** by **{0.uploader}**".format(self)
 
     @classmethod
     async def create_source(
-        cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None
+        cls,
+        ctx: commands.Context,
+        search: str,
+        *,
+        loop: asyncio.BaseEventLoop = None,
+        trace: PlayTrace = None,
     ):
         # print('debug 6')
         loop = loop or asyncio.get_event_loop()
@@ -101,7 +635,8 @@ class YTDLSource(discord.PCMVolumeTransformer):
         partial = functools.partial(
             cls.ytdl.extract_info, search, download=False, process=False
         )
-        data = await loop.run_in_executor(None, partial)
+        with trace_span(trace, "extract_info.search", search=search):
+            data = await loop.run_in_executor(None, partial)
 
         if data is None:
             raise YTDLError("Couldn't find anything that matches `{}`".format(search))
@@ -122,7 +657,8 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
         webpage_url = process_info["webpage_url"]
         partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        with trace_span(trace, "extract_info.process"):
+            processed_info = await loop.run_in_executor(None, partial)
 
         if processed_info is None:
             raise YTDLError("Couldn't fetch `{}`".format(webpage_url))
@@ -139,10 +675,57 @@ class YTDLSource(discord.PCMVolumeTransformer):
                         "Couldn't retrieve any matches for `{}`".format(webpage_url)
                     )
 
-        return cls(
-            ctx, discord.FFmpegPCMAudio(info["url"], **cls.FFMPEG_OPTIONS), data=info
+        # 再生先のチャンネルのビットレートに合わせてフォーマットを選び直す
+        destination = ctx.voice_client.channel if ctx.voice_client else None
+        bitrate = getattr(destination, "bitrate", None)
+        audio_formats = [
+            f
+            for f in info.get("formats") or []
+            if f.get("acodec") != "none" and f.get("vcodec") == "none"
+        ]
+        fmt = cls.select_format(audio_formats, bitrate)
+        if fmt:
+            info = dict(info, **fmt)
+        info["channel_bitrate"] = bitrate
+        info["bestaudio_abr"] = max(
+            (f.get("abr") or f.get("tbr") or 0 for f in audio_formats), default=None
         )
 
+        with trace_span(trace, "ffmpeg_spawn"):
+            source = BufferedAudio(
+                discord.FFmpegPCMAudio(info["url"], **cls.FFMPEG_OPTIONS),
+                depth=cls.BUFFER_FRAMES,
+            )
+
+        return cls(ctx, source, data=info)
+
+    @staticmethod
+    def select_format(formats: list, bitrate: int = None):
+        """チャンネルのビットレート (bps) を満たす中で最も小さい音声フォーマットを返します。
+        同じビットレートならOpus (Discordと同じコーデック) を優先します。
+        満たすものがなければ最も大きいものを、候補がなければNoneを返します。
+        DASHやHLSのマニフェストはffmpegにそのまま渡せないため、HTTP(S)のものだけを選びます。
+        """
+
+        candidates = [
+            f
+            for f in formats
+            if f.get("protocol") in ("http", "https")
+            and f.get("url")
+            and (f.get("abr") or f.get("tbr"))
+        ]
+        if not bitrate or not candidates:
+            return None
+
+        def abr(f):
+            return f.get("abr") or f.get("tbr")
+
+        target = bitrate / 1000
+        enough = [f for f in candidates if abr(f) >= target]
+        if enough:
+            return min(enough, key=lambda f: (abr(f), f.get("acodec") != "opus"))
+        return max(candidates, key=lambda f: (abr(f), f.get("acodec") == "opus"))
+
     @staticmethod
     def parse_duration(duration: int):
         minutes, seconds = divmod(duration, 60)
@@ -163,11 +746,16 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
 
 class Song:
-    __slots__ = ("source", "requester")
+    __slots__ = ("source", "requester", "trace")
 
-    def __init__(self, source: YTDLSource):
+    def __init__(self, source: YTDLSource, trace: PlayTrace = None):
         self.source = source
         self.requester = source.requester
+        self.trace = trace
+
+    def drop(self, reason: str):
+        if self.trace:
+            self.trace.drop(reason)
 
     def create_embed(self):
         embed = (
@@ -203,16 +791,22 @@ class SongQueue(asyncio.Queue):
         return self.qsize()
 
     def clear(self):
+        for song in self._queue:
+            song.drop("キューから削除されました")
         self._queue.clear()
 
     def shuffle(self):
         random.shuffle(self._queue)
 
     def remove(self, index: int):
+        self._queue[index].drop("キューから削除されました")
         del self._queue[index]
 
 
 class VoiceState:
+    # 聞いている人がいなくなってから退出するまでの秒数
+    IDLE_TIMEOUT = int(os.environ.get("IDLE_DISCONNECT_SECONDS", 180))
+
     def __init__(self, bot: commands.Bot, ctx: commands.Context):
         self.bot = bot
         self._ctx = ctx
@@ -231,6 +825,14 @@ class VoiceState:
         self.exists = True
         ### henkou tyop ###
 
+        # 聞いている人がいない間は再生を中断する
+        self.suspended = False
+        self._listening = asyncio.Event()
+        self._listening.set()
+        self._suspended_paused = False
+        self._idle_timer = None
+        self._resuming = None
+
         self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     def __del__(self):
@@ -271,6 +873,9 @@ class VoiceState:
             self.next.clear()
             self.now = None
 
+            # 聞いている人が戻るまで、次の曲やデフォルト曲を取りに行かない
+            await self._listening.wait()
+
             # print('Tasks count: ', len(asyncio.Task.all_tasks()))
             if idx == 5:
                 self._autoplay = False
@@ -280,6 +885,10 @@ class VoiceState:
                     async with timeout(3):  # 3秒
                         self.current = await self.songs.get()
                 except asyncio.TimeoutError:
+                    if self.suspended:
+                        # 待っている間に誰もいなくなった場合は、デフォルト曲を取りに行かない
+                        continue
+
                     default_music_url_list = [
                         "https://youtu.be/Lwlunrt_v0E",  # YOASOBI Playlist 2021
                         "https://youtu.be/yxHZXhxjWgM",  # JPOPメドレー 2021
@@ -330,6 +939,22 @@ class VoiceState:
                     idx = 0
                     return
 
+            if self.current.trace:
+                self.current.trace.dequeued()
+                self.current.source.trace = self.current.trace
+
+            # 再生前にバッファを埋める。その間や曲の取得中に誰もいなくなった場合は、
+            # ffmpegを解放して戻るまで待つ
+            while True:
+                if self.suspended:
+                    self.current.source.cleanup()
+                    await self._listening.wait()
+                if self.current.source.released:
+                    self.current.source = self.current.source.seek(0)
+                await self.current.source.prime(self.bot.loop)
+                if not self.suspended:
+                    break
+
             # print('debug 1')
             self.current.source.volume = self._volume
             # print('debug 2')
@@ -340,6 +965,9 @@ class VoiceState:
 
             await self.next.wait()
 
+            # 最初のフレームを送る前にスキップ・停止された場合
+            self.current.drop("再生前に停止されました")
+
     def play_next_song(self, error=None, volume: float = 0.5):
         if error:
             raise VoiceError(str(error))
@@ -353,8 +981,86 @@ class VoiceState:
         if self.is_playing:
             self.voice.stop()
 
+    def suspend(self):
+        """再生を中断し、ffmpegとストリームを解放します。位置は再開用に保持します。"""
+        if self._resuming:
+            # 再開のためにバッファを埋めている途中だった
+            self._resuming.cleanup()
+            self._resuming = None
+        elif self.suspended:
+            return
+        else:
+            self.suspended = True
+            self._listening.clear()
+
+            if self.voice and (self.voice.is_playing() or self.voice.is_paused()):
+                self._suspended_paused = self.voice.is_paused()
+                self.voice.pause()
+                self.voice.source.cleanup()
+            elif self.current and not self.current.source.released:
+                # 再生前にバッファを埋めている途中だった。待つのをやめて解放する
+                self.current.source.cleanup()
+
+        # キューで待っている曲のffmpegも解放する。再生する前に取り直す
+        for song in self.songs:
+            song.source.cleanup()
+
+        self._idle_timer = self.bot.loop.create_task(self._leave_when_idle())
+
+    async def resume(self):
+        """中断した曲を、中断した位置から再開します。
+        新しいソースのバッファが埋まって差し替えるまでは、suspendedのままです。
+        """
+        if not self.suspended or self._resuming:
+            return
+        if self._idle_timer:
+            self._idle_timer.cancel()
+
+        if self.voice and self.voice.is_paused():
+            source = self._resuming = self.voice.source.seek(self.voice.source.position)
+            await source.prime(self.bot.loop)
+            if self._resuming is not source:
+                # バッファを待つ間に再び中断された
+                return
+            self._resuming = None
+            if not (self.voice and self.voice.is_paused()):
+                # バッファを待つ間に停止された
+                source.cleanup()
+            else:
+                self._swap_source(source)
+                self.current.source = source
+                if not self._suspended_paused:
+                    self.voice.resume()
+
+        self.suspended = False
+        self._listening.set()
+
+    def _swap_source(self, source: YTDLSource):
+        """一時停止中のプレイヤーの音源を、再開させずに差し替えます。
+        VoiceClient.sourceへの代入はプレイヤーを再開してしまうため、AudioPlayerを直接書き換えます。
+        一時停止中のプレイヤースレッドはresumeされるまでsourceを読まないので、
+        プレイヤーが一時停止していることが前提です。
+        """
+        self.voice._player.source = source
+
+    async def _leave_when_idle(self):
+        await asyncio.sleep(self.IDLE_TIMEOUT)
+
+        # stop()で自分自身をキャンセルしないようにする
+        self._idle_timer = None
+        self.exists = False
+        self.audio_player.cancel()
+        await self.stop()
+        await self._ctx.send("聞いている人がいないため、音声チャンネルから退出しました。")
+
     async def stop(self):
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
         self.songs.clear()
+        if self.current:
+            self.current.drop("再生前に停止されました")
 
         if self.voice:
             await self.voice.disconnect()
@@ -362,9 +1068,10 @@ class VoiceState:
 
 
 class Music(commands.Cog):
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, tracer: Tracer = None):
         self.bot = bot
         self.voice_states = {}
+        self.tracer = tracer or Tracer.from_env()
 
     def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
@@ -380,6 +1087,7 @@ class Music(commands.Cog):
     def cog_unload(self):
         for state in self.voice_states.values():
             self.bot.loop.create_task(state.stop())
+        self.bot.loop.create_task(self.tracer.close())
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -410,12 +1118,36 @@ class Music(commands.Cog):
                     ] = "https://www.youtube.com/watch?v=" + video.get("id")
             return playlist, playlistTitle
 
+    @commands.Cog.listener()
+    async def on_voice_state_update(
+        self,
+        member: discord.Member,
+        before: discord.VoiceState,
+        after: discord.VoiceState,
+    ):
+        state = self.voice_states.get(member.guild.id)
+        if not state or not state.voice:
+            return
+
+        channel = state.voice.channel
+        if before.channel != channel and after.channel != channel:
+            return
+
+        if any(not m.bot for m in channel.members):
+            await state.resume()
+        else:
+            state.suspend()
+
     async def cog_before_invoke(self, ctx: commands.Context):
         ctx.voice_state = self.get_voice_state(ctx)
 
     async def cog_command_error(
         self, ctx: commands.Context, error: commands.CommandError
     ):
+        trace = getattr(ctx, "trace", None)
+        if trace:
+            trace.finish(error)
+
         await ctx.send("エラーが発生しました: {}".format(str(error)))
 
     @commands.command(name="join", invoke_without_subcommand=True)
@@ -423,11 +1155,12 @@ class Music(commands.Cog):
         """ボイスチャネルへの参加。"""
 
         destination = ctx.author.voice.channel
-        if ctx.voice_state.voice:
-            await ctx.voice_state.voice.move_to(destination)
-            return
+        with trace_span(getattr(ctx, "trace", None), "voice_connect"):
+            if ctx.voice_state.voice:
+                await ctx.voice_state.voice.move_to(destination)
+                return
 
-        ctx.voice_state.voice = await destination.connect()
+            ctx.voice_state.voice = await destination.connect()
 
     @commands.command(name="summon")
     @commands.has_permissions(manage_guild=True)
@@ -498,6 +1231,9 @@ class Music(commands.Cog):
     async def _resume(self, ctx: commands.Context):
         """一時停止中の曲を再開します。"""
 
+        if ctx.voice_state.suspended:
+            return await ctx.send("聞いている人がいないため、再生を中断しています。")
+
         ### henkou tyop ###
         if not ctx.voice_state.voice.is_playing():
             ctx.voice_state.voice.resume()
@@ -651,18 +1387,26 @@ class Music(commands.Cog):
         if search.__contains__("?list="):
             print("プレイリストを再生します")
             await ctx.send("プレイリストを読み込んでいます...")
+            # time-to-first-audioは最初にキューに入った曲で計測する
+            trace = ctx.trace
             async with ctx.typing():
-                playlist, playlistTitle = self._playlist(search)
+                with trace_span(trace, "extract_info.playlist"):
+                    playlist, playlistTitle = self._playlist(search)
                 for _title, _link in playlist.items():
                     try:
                         source = await YTDLSource.create_source(
-                            ctx, _link, loop=self.bot.loop
+                            ctx, _link, loop=self.bot.loop, trace=trace
                         )
                     except YTDLError as e:
                         await ctx.send("このリクエストの処理中にエラーが発生しました: {}".format(str(e)))
                     else:
-                        song = Song(source)
+                        song = Song(source, trace)
+                        if trace:
+                            trace.queued()
+                            trace = None
                         await ctx.voice_state.songs.put(song)
+                if trace:
+                    trace.finish(YTDLError("Couldn't load any playlist entries"))
                 await ctx.send(
                     f"`{playlist.__len__()}` 曲がキューに入りました。 from **{playlistTitle}**"
                 )
@@ -671,25 +1415,31 @@ class Music(commands.Cog):
             async with ctx.typing():
                 try:
                     source = await YTDLSource.create_source(
-                        ctx, search, loop=self.bot.loop
+                        ctx, search, loop=self.bot.loop, trace=ctx.trace
                     )
                 except YTDLError as e:
+                    ctx.trace.finish(e)
                     await ctx.send("このリクエストの処理中にエラーが発生しました: {}".format(str(e)))
                 else:
-                    song = Song(source)
+                    song = Song(source, ctx.trace)
 
+                    ctx.trace.queued()
                     await ctx.voice_state.songs.put(song)
                     await ctx.send("{} を再生中です。".format(str(source)))
 
     @_join.before_invoke
     @_play.before_invoke
     async def ensure_voice_state(self, ctx: commands.Context):
-        if not ctx.author.voice or not ctx.author.voice.channel:
-            raise commands.CommandError("私はどの音声チャンネルにも入っていません。")
+        if ctx.command.name == "play":
+            ctx.trace = self.tracer.start_play(ctx)
+
+        with trace_span(getattr(ctx, "trace", None), "ensure_voice_state"):
+            if not ctx.author.voice or not ctx.author.voice.channel:
+                raise commands.CommandError("私はどの音声チャンネルにも入っていません。")
 
-        if ctx.voice_client:
-            if ctx.voice_client.channel != ctx.author.voice.channel:
-                raise commands.CommandError("私はすでに音声チャンネルに入っています。")
+            if ctx.voice_client:
+                if ctx.voice_client.channel != ctx.author.voice.channel:
+                    raise commands.CommandError("私はすでに音声チャンネルに入っています。")
 
 
 bot = commands.Bot("!", description="music botの使い方")
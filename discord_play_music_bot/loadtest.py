@@ -0,0 +1,838 @@
+# -*- coding: utf-8 -*-
+
+"""
+Musicコグの負荷試験ハーネスです。
+本物の Music コグを、ローカルのゲートウェイ / ボイスエンドポイントの代役に繋いで起動し、
+N個のギルドから !play / !skip / !queue / プレイリスト読み込みを発行します。
+音源はローカルで生成したWAVをローカルHTTPサーバから配信するので、ネットワークは不要です。
+ギルド数を増やしながら、フレーム送出のジッタ、コマンドのレイテンシ、CPUとRSSを報告します。
+
+使い方
+python -m discord_play_music_bot.loadtest --guilds 1,4,16 --duration 60
+FFmpegがPATH上に、libopusが読み込める場所にある必要があります (--opus でパスを指定できます)。
+"""
+
+import argparse
+import asyncio
+import datetime
+import functools
+import http.server
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import wave
+from unittest import mock
+
+import discord
+import youtube_dl
+from discord.ext import commands
+from discord.player import AudioPlayer
+
+from discord_play_music_bot.__main__ import Music, OTLPSpanExporter, Tracer, YTDLSource
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_INTERVAL = AudioPlayer.DELAY
+
+# 送出間隔がこれ以上ずれたフレームを「遅延フレーム」として数える
+LATE_FRAME_THRESHOLD = 0.005
+
+
+def write_tone(path: str, seconds: float, frequency: float = 440.0):
+    """48kHz / ステレオ / 16bitのサイン波WAVを書き出します。"""
+
+    period = [
+        int(12000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)).to_bytes(
+            2, "little", signed=True
+        )
+        * CHANNELS
+        for i in range(SAMPLE_RATE)
+    ]
+    second = b"".join(period)
+
+    with wave.open(path, "wb") as w:
+        w.setnchannels(CHANNELS)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        whole, rest = divmod(seconds, 1)
+        for _ in range(int(whole)):
+            w.writeframes(second)
+        w.writeframes(second[: int(rest * SAMPLE_RATE) * CHANNELS * 2])
+
+
+class _LocalHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        # OTLP/HTTP (JSON) コレクタの代役
+        if self.path != "/v1/traces":
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length))
+        for resource_spans in payload["resourceSpans"]:
+            for scope_spans in resource_spans["scopeSpans"]:
+                self.server.spans.extend(scope_spans["spans"])
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+class LocalServer:
+    """生成した音源の配信と、OTLPコレクタの代役を兼ねるローカルHTTPサーバです。"""
+
+    def __init__(self, directory: str):
+        handler = functools.partial(_LocalHandler, directory=directory)
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._httpd.spans = []
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def take_spans(self):
+        """受信済みのスパンを取り出します。"""
+        spans, self._httpd.spans = self._httpd.spans, []
+        return spans
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class LocalYoutubeDL:
+    """youtube_dl.YoutubeDL の代役です。
+
+    検索・動画・プレイリストのいずれにも、ローカルの音源を指す情報を返します。
+    ``delay`` 秒だけ待つことで、YouTubeへの問い合わせにかかる時間を模擬します。
+    """
+
+    def __init__(
+        self,
+        params: dict = None,
+        *,
+        audio_url: str,
+        duration: int,
+        delay: float,
+        playlist_size: int,
+    ):
+        self.params = params or {}
+        self.audio_url = audio_url
+        self.duration = duration
+        self.delay = delay
+        self.playlist_size = playlist_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True):
+        time.sleep(self.delay)
+
+        if "?list=" in url:
+            list_id = url.split("?list=", 1)[1]
+            return {
+                "_type": "playlist",
+                "title": "Load test playlist {}".format(list_id),
+                "entries": [
+                    {"id": "{}-{}".format(list_id, i), "title": "Track {}".format(i)}
+                    for i in range(self.playlist_size)
+                ],
+            }
+
+        if not url.startswith("http"):
+            video_id = url.replace(" ", "-")
+            return {
+                "_type": "playlist",
+                "entries": [
+                    {"webpage_url": "https://www.youtube.com/watch?v=" + video_id}
+                ],
+            }
+
+        if not process:
+            return {"webpage_url": url}
+
+        return {
+            "title": url.rsplit("=", 1)[-1],
+            "uploader": "loadtest",
+            "uploader_url": "http://127.0.0.1/",
+            "upload_date": "20210101",
+            "thumbnail": None,
+            "description": "",
+            "duration": self.duration,
+            "tags": [],
+            "webpage_url": url,
+            "view_count": 0,
+            "like_count": 0,
+            "dislike_count": 0,
+            "url": self.audio_url,
+            # YouTubeと同じ構成の音声フォーマット (中身はどれも同じ音源)。
+            # DASHのマニフェストは選ばれてはいけないので、存在しないURLにしておく
+            "formats": [
+                {
+                    "format_id": format_id,
+                    "acodec": acodec,
+                    "vcodec": "none",
+                    "abr": abr,
+                    "protocol": protocol,
+                    "url": self.audio_url if protocol == "http" else "/missing.mpd",
+                }
+                for format_id, acodec, abr, protocol in [
+                    ("249", "opus", 50, "http"),
+                    ("dash-opus", "opus", 64, "http_dash_segments"),
+                    ("250", "opus", 70, "http"),
+                    ("140", "mp4a.40.2", 129, "http"),
+                    ("251", "opus", 160, "http"),
+                ]
+            ],
+        }
+
+
+class Stats:
+    """負荷試験1段分の計測値です。複数のプレイヤースレッドから更新されます。"""
+
+    def __init__(self):
+        self.frame_intervals = []
+        self.frame_bytes = 0
+        self.not_speaking_frames = 0
+        self.command_latency = {}
+        self.command_errors = 0
+        self.underruns = 0
+        self._lock = threading.Lock()
+
+    def record_frame(self, interval, size, speaking):
+        with self._lock:
+            if interval is not None:
+                self.frame_intervals.append(interval)
+            self.frame_bytes += size
+            if not speaking:
+                self.not_speaking_frames += 1
+
+    def record_underruns(self, count):
+        with self._lock:
+            self.underruns += count
+
+    def record_command(self, name, seconds):
+        self.command_latency.setdefault(name, []).append(seconds)
+
+
+class UdpSink:
+    """ボイスサーバの代役です。送られてきたRTPパケットを受け取って捨てます。"""
+
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("127.0.0.1", 0))
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self.packets = 0
+
+    @property
+    def address(self):
+        return self._socket.getsockname()
+
+    def _drain(self):
+        buffer = bytearray(2048)
+        while True:
+            try:
+                self._socket.recv_into(buffer)
+            except OSError:
+                return
+            self.packets += 1
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._socket.close()
+
+
+class _LocalVoiceWebSocket:
+    """ボイスゲートウェイの代役です。speakingの状態だけを保持します。"""
+
+    def __init__(self):
+        self.speaking = False
+
+    def speak(self, state: bool = True):
+        # プレイヤースレッドから呼ばれるので、コルーチンの実行を待たずに状態を反映する
+        self.speaking = state
+        return asyncio.sleep(0)
+
+    async def close(self):
+        pass
+
+
+class LocalVoiceClient(discord.VoiceClient):
+    """送信先をローカルのUdpSinkに向けた本物の discord.VoiceClient です。
+
+    Opusエンコード、RTPヘッダの組み立て、暗号化、UDP送信までは本物と同じ経路を通り、
+    送出されたフレームの時刻を記録します。
+    """
+
+    def __init__(self, client, channel, sink: UdpSink, stats: Stats):
+        super().__init__(client, channel)
+        self._stats = stats
+        self._last_frame = None
+
+        self.ws = _LocalVoiceWebSocket()
+        self.mode = "xsalsa20_poly1305_lite"
+        self.secret_key = list(os.urandom(32))
+        self.ssrc = random.getrandbits(32)
+        self.endpoint_ip, self.voice_port = sink.address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self._connected.set()
+
+    def send_audio_packet(self, data, *, encode=True):
+        super().send_audio_packet(data, encode=encode)
+
+        now = time.perf_counter()
+        interval = None if self._last_frame is None else now - self._last_frame
+        self._last_frame = now
+        self._stats.record_frame(interval, len(data), self.ws.speaking)
+
+    def play(self, source, *, after=None):
+        def finished(error):
+            # ジッタバッファが無音で埋めたフレーム数を集計する。
+            # 中断から再開した場合は、差し替え後のソースを見る
+            original = getattr(player.source, "original", None)
+            self._stats.record_underruns(getattr(original, "underruns", 0))
+            if after is not None:
+                after(error)
+
+        self._last_frame = None
+        super().play(source, after=finished)
+        player = self._player
+
+    @discord.VoiceClient.source.setter
+    def source(self, value):
+        self._last_frame = None
+        discord.VoiceClient.source.fset(self, value)
+
+    def resume(self):
+        self._last_frame = None
+        super().resume()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected.clear()
+        self.socket.close()
+        self.guild.voice_client = None
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class LocalGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = "guild-{}".format(guild_id)
+        self.voice_client = None
+
+
+class LocalTextChannel:
+    def __init__(self, guild: LocalGuild, latency: float):
+        self.id = guild.id * 10 + 1
+        self.guild = guild
+        self.latency = latency
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        # Discord REST API への往復時間
+        await asyncio.sleep(self.latency)
+
+    def typing(self):
+        return _Typing()
+
+    async def purge(self, *, limit=100):
+        await asyncio.sleep(self.latency)
+
+
+class LocalVoiceChannel:
+    def __init__(
+        self,
+        guild: LocalGuild,
+        bot: commands.Bot,
+        sink: UdpSink,
+        stats: Stats,
+        bitrate: int = 64000,
+    ):
+        self.id = guild.id * 10 + 2
+        self.guild = guild
+        self.bitrate = bitrate
+        self.members = []
+        self._bot = bot
+        self._sink = sink
+        self._stats = stats
+
+    async def connect(self):
+        voice = LocalVoiceClient(self._bot, self, self._sink, self._stats)
+        self.guild.voice_client = voice
+        return voice
+
+
+class LocalMember:
+    def __init__(self, member_id: int, voice_channel=None, *, bot: bool = False):
+        self.id = member_id
+        self.name = "member-{}".format(member_id)
+        self.display_name = self.name
+        self.mention = "<@{}>".format(member_id)
+        self.bot = bot
+        self.guild = voice_channel.guild if voice_channel else None
+        self.voice = _MemberVoice(voice_channel) if voice_channel else None
+        if voice_channel:
+            voice_channel.members.append(self)
+
+
+class _MemberVoice:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class LocalMessage:
+    _ids = 0
+
+    def __init__(self, content: str, author, channel: LocalTextChannel):
+        LocalMessage._ids += 1
+        self.id = LocalMessage._ids
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.created_at = datetime.datetime.utcnow()
+        self._state = None
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(self.channel.latency)
+
+
+class LocalContext(commands.Context):
+    """ローカルのチャンネルへ送信するContextです。"""
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return self.channel.typing()
+
+
+class LocalGateway:
+    """ゲートウェイの代役です。メッセージを組み立ててコマンドとして配送します。"""
+
+    def __init__(self, bot: commands.Bot, stats: Stats):
+        self.bot = bot
+        self.stats = stats
+        # READY 相当: ボット自身のユーザーを設定する
+        bot._connection.user = LocalMember(0, bot=True)
+
+    def move(self, member: LocalMember, channel: "LocalVoiceChannel" = None):
+        """メンバーをボイスチャンネルへ出入りさせ、voice_state_updateを配送します。"""
+        before = member.voice
+        if before:
+            before.channel.members.remove(member)
+        member.voice = _MemberVoice(channel) if channel else None
+        if channel:
+            channel.members.append(member)
+        self.bot.dispatch(
+            "voice_state_update",
+            member,
+            before or _MemberVoice(None),
+            member.voice or _MemberVoice(None),
+        )
+
+    async def dispatch(self, content: str, author, channel: LocalTextChannel):
+        message = LocalMessage(content, author, channel)
+        name = content[1:].split(" ", 1)[0]
+        if name == "play" and "?list=" in content:
+            name = "playlist"
+
+        start = time.perf_counter()
+        try:
+            ctx = await self.bot.get_context(message, cls=LocalContext)
+            await self.bot.invoke(ctx)
+            if ctx.command_failed:
+                self.stats.command_errors += 1
+        finally:
+            self.stats.record_command(name, time.perf_counter() - start)
+
+
+class Schedule:
+    """ギルドごとのコマンド発行スケジュールです。
+
+    ``rate`` はギルドあたりの毎秒のコマンド数で、発行間隔は指数分布に従います。
+    ``mix`` はコマンドごとの重みです。
+    """
+
+    def __init__(self, rate: float, mix: dict):
+        self.rate = rate
+        self.mix = mix
+
+    @classmethod
+    def parse_mix(cls, text: str):
+        mix = {}
+        for item in text.split(","):
+            name, weight = item.split("=")
+            if name not in ("play", "skip", "queue", "playlist"):
+                raise ValueError("Unknown command in mix: {}".format(name))
+            mix[name] = float(weight)
+        return mix
+
+    def next_command(self, rng: random.Random):
+        name = rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        n = rng.randrange(10000)
+        if name == "play":
+            return "!play track {}".format(n)
+        if name == "playlist":
+            return "!play https://www.youtube.com/playlist?list=LT{}".format(n)
+        return "!" + name
+
+
+def _time_to_first_audio(spans: list):
+    """コレクタが受け取ったスパンから、成功したトレースのTTFAと段階ごとの所要時間を集計します。"""
+
+    def millis(span):
+        return (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+
+    ok = {
+        s["traceId"]
+        for s in spans
+        if "parentSpanId" not in s and s["status"]["code"] != 2
+    }
+    ttfa = []
+    stages = {}
+    for span in spans:
+        if span["traceId"] not in ok:
+            continue
+        if "parentSpanId" not in span:
+            ttfa.append(millis(span))
+        else:
+            stages.setdefault(span["name"], []).append(millis(span))
+    return ttfa, stages
+
+
+def percentile(values, q: float):
+    """最近傍順位法によるパーセンタイルです。"""
+
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def _rss_bytes(pid="self"):
+    try:
+        with open("/proc/{}/statm".format(pid)) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _children_rss_bytes():
+    """このプロセスの子プロセス (ffmpeg) のRSS合計です。Linux以外では0になります。"""
+
+    total = 0
+    me = str(os.getpid())
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return 0
+
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if fields[1] == me:
+            total += _rss_bytes(pid)
+    return total
+
+
+async def _sample_memory(samples: list, interval: float = 1.0):
+    while True:
+        samples.append((_rss_bytes(), _children_rss_bytes()))
+        await asyncio.sleep(interval)
+
+
+async def _drive_guild(
+    gateway: LocalGateway,
+    guild_id: int,
+    schedule: Schedule,
+    rng: random.Random,
+    deadline: float,
+    stats: Stats,
+    latency: float,
+    sink: UdpSink,
+    away: tuple = None,
+):
+    """1ギルド分のコマンドを発行します。
+    ``away`` が (離席時刻, 復帰時刻) なら、その間リスナーはボイスチャンネルを離れ、コマンドも送りません。
+    """
+    loop = asyncio.get_event_loop()
+    guild = LocalGuild(guild_id)
+    text = LocalTextChannel(guild, latency)
+    voice = LocalVoiceChannel(guild, gateway.bot, sink, stats)
+    member = LocalMember(guild_id * 10 + 3, voice)
+
+    if away:
+        loop.call_at(away[0], gateway.move, member, None)
+        loop.call_at(away[1], gateway.move, member, voice)
+
+    commands_sent = [loop.create_task(gateway.dispatch("!play track 0", member, text))]
+    while loop.time() < deadline:
+        await asyncio.sleep(rng.expovariate(schedule.rate))
+        if member.voice is None:
+            continue
+        content = schedule.next_command(rng)
+        # オープンループ: 前のコマンドの完了を待たずに次を発行する
+        commands_sent.append(loop.create_task(gateway.dispatch(content, member, text)))
+
+    await asyncio.gather(*commands_sent, return_exceptions=True)
+
+
+async def run_step(n_guilds: int, args, server: LocalServer, sink: UdpSink):
+    """N ギルド分の負荷を ``args.duration`` 秒かけ、計測結果を返します。"""
+
+    loop = asyncio.get_event_loop()
+    stats = Stats()
+    bot = commands.Bot("!", loop=loop)
+    tracer = Tracer([OTLPSpanExporter(server.base_url + "/v1/traces")])
+    cog = Music(bot, tracer)
+    server.take_spans()
+    bot.add_cog(cog)
+    gateway = LocalGateway(bot, stats)
+    schedule = Schedule(args.rate, Schedule.parse_mix(args.mix))
+
+    packets_start = sink.packets
+    memory = []
+    sampler = loop.create_task(_sample_memory(memory))
+    cpu_start = os.times()
+    wall_start = time.perf_counter()
+    deadline = loop.time() + args.duration
+
+    # --away の割合 (切り上げ) のギルドでは、計測区間の1/3から2/3までリスナーが離席する
+    n_away = math.ceil(n_guilds * args.away)
+    now = loop.time()
+    away = (now + args.duration / 3, now + args.duration * 2 / 3)
+    drivers = [
+        _drive_guild(
+            gateway,
+            i + 1,
+            schedule,
+            random.Random(args.seed * 100003 + i),
+            deadline,
+            stats,
+            args.rest_latency,
+            sink,
+            away if i < n_away else None,
+        )
+        for i in range(n_guilds)
+    ]
+    # 応答しないコマンドがあっても計測が終わるよう上限を設ける
+    _, pending = await asyncio.wait(
+        [loop.create_task(d) for d in drivers], timeout=args.duration + 30
+    )
+    # 残ったコマンドが次のステップの計測に混ざらないよう止める
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    cpu_end = os.times()
+    wall = time.perf_counter() - wall_start
+    sampler.cancel()
+
+    for state in list(cog.voice_states.values()):
+        state.audio_player.cancel()
+        await state.stop()
+    bot.remove_cog(cog.qualified_name)
+    # プレイヤースレッドが ffmpeg を片付け、トレースの送信が終わるのを待つ
+    await asyncio.sleep(0.5)
+    ttfa, stages = _time_to_first_audio(server.take_spans())
+
+    cpu = (cpu_end.user + cpu_end.system) - (cpu_start.user + cpu_start.system)
+    children = (cpu_end.children_user + cpu_end.children_system) - (
+        cpu_start.children_user + cpu_start.children_system
+    )
+    jitter = [abs(i - FRAME_INTERVAL) for i in stats.frame_intervals]
+    late = sum(1 for j in jitter if j > LATE_FRAME_THRESHOLD)
+
+    return {
+        "guilds": n_guilds,
+        "seconds": wall,
+        "frames": len(stats.frame_intervals),
+        "frame_bytes": stats.frame_bytes,
+        "udp_packets": sink.packets - packets_start,
+        "not_speaking_frames": stats.not_speaking_frames,
+        "jitter_ms": {
+            "p50": percentile(jitter, 50) * 1000,
+            "p99": percentile(jitter, 99) * 1000,
+            "max": max(jitter, default=float("nan")) * 1000,
+        },
+        "late_frames": late,
+        "underruns": stats.underruns,
+        "commands": {
+            name: {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+            for name, values in sorted(stats.command_latency.items())
+        },
+        "command_errors": stats.command_errors,
+        "time_to_first_audio_ms": {
+            "count": len(ttfa),
+            "p50": percentile(ttfa, 50),
+            "p95": percentile(ttfa, 95),
+            "p99": percentile(ttfa, 99),
+        },
+        "stage_p50_ms": {
+            name: percentile(values, 50) for name, values in sorted(stages.items())
+        },
+        "cpu_percent": cpu / wall * 100,
+        "children_cpu_percent": children / wall * 100,
+        "rss_mb": max((m[0] for m in memory), default=0) / 2 ** 20,
+        "ffmpeg_rss_mb": max((m[1] for m in memory), default=0) / 2 ** 20,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def format_result(result: dict):
+    lines = [
+        "=== {guilds} guilds / {seconds:.0f} 秒 ===".format(**result),
+        "frames: {frames}  遅延フレーム: {late} ({ratio:.2f}%)".format(
+            frames=result["frames"],
+            late=result["late_frames"],
+            ratio=result["late_frames"] / max(result["frames"], 1) * 100,
+        ),
+        "UDP受信: {udp_packets}  speaking off のまま送出: {not_speaking_frames}".format(
+            **result
+        ),
+        "buffer underruns: {}".format(result["underruns"]),
+        "jitter: p50 {p50:.2f} ms  p99 {p99:.2f} ms  max {max:.2f} ms".format(
+            **result["jitter_ms"]
+        ),
+        "CPU: bot {cpu_percent:.1f}%  ffmpeg(回収済み) {children_cpu_percent:.1f}%".format(
+            **result
+        ),
+        "RSS: bot {rss_mb:.1f} MB (peak {peak_rss_mb:.1f} MB)"
+        "  ffmpeg {ffmpeg_rss_mb:.1f} MB".format(**result),
+        "time-to-first-audio: n={count}  p50 {p50:.0f} ms  p95 {p95:.0f} ms"
+        "  p99 {p99:.0f} ms".format(**result["time_to_first_audio_ms"]),
+        "  stage p50: "
+        + ", ".join(
+            "{} {:.0f} ms".format(name, value)
+            for name, value in result["stage_p50_ms"].items()
+        ),
+        "commands (エラー {}):".format(result["command_errors"]),
+    ]
+    for name, c in result["commands"].items():
+        lines.append(
+            "  {name:<9} n={count:<5} p50 {p50_ms:8.1f} ms  p95 {p95_ms:8.1f} ms"
+            "  p99 {p99_ms:8.1f} ms".format(name=name, **c)
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Musicコグの負荷試験")
+    parser.add_argument("--guilds", default="1,2,4,8", help="カンマ区切りのギルド数 (段ごとに実行)")
+    parser.add_argument("--duration", type=float, default=30.0, help="1段あたりの秒数")
+    parser.add_argument("--rate", type=float, default=0.1, help="ギルドあたりの毎秒のコマンド数")
+    parser.add_argument(
+        "--mix",
+        default="play=4,skip=2,queue=3,playlist=1",
+        help="コマンドの重み (play, skip, queue, playlist)",
+    )
+    parser.add_argument("--track-seconds", type=int, default=20, help="生成する曲の長さ")
+    parser.add_argument("--playlist-size", type=int, default=5)
+    parser.add_argument(
+        "--extract-delay", type=float, default=0.2, help="extract_info 1回の模擬待ち時間"
+    )
+    parser.add_argument(
+        "--rest-latency", type=float, default=0.05, help="メッセージ送信の模擬往復時間"
+    )
+    parser.add_argument(
+        "--away", type=float, default=0.0, help="途中でリスナーが離席するギルドの割合 (ギルド数は切り上げ)"
+    )
+    parser.add_argument("--opus", help="libopusのパス (自動で見つからない場合)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果をJSONで書き出すパス")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if shutil.which("ffmpeg") is None:
+        raise SystemExit("FFmpegがPATH上に見つかりません。")
+    if args.opus:
+        discord.opus.load_opus(args.opus)
+    try:
+        discord.opus.Encoder()
+    except discord.opus.OpusNotLoaded:
+        raise SystemExit("libopusが見つかりません。--opus でパスを指定してください。")
+
+    directory = tempfile.mkdtemp(prefix="music-loadtest-")
+    write_tone(os.path.join(directory, "tone.wav"), args.track_seconds)
+    server = LocalServer(directory)
+    server.start()
+    sink = UdpSink()
+    sink.start()
+
+    ydl = functools.partial(
+        LocalYoutubeDL,
+        audio_url=server.base_url + "/tone.wav",
+        duration=args.track_seconds,
+        delay=args.extract_delay,
+        playlist_size=args.playlist_size,
+    )
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    try:
+        with mock.patch.object(youtube_dl, "YoutubeDL", ydl), mock.patch.object(
+            YTDLSource, "ytdl", ydl(YTDLSource.YTDL_OPTIONS)
+        ):
+            for n in [int(g) for g in args.guilds.split(",")]:
+                result = loop.run_until_complete(run_step(n, args, server, sink))
+                results.append(result)
+                print(format_result(result), flush=True)
+    finally:
+        loop.close()
+        server.close()
+        sink.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+import discord
+import pytest
+
+from discord_play_music_bot.__main__ import BufferedAudio, FrameRing
+
+FRAME_SIZE = BufferedAudio.FRAME_SIZE
+
+
+def frame(n: int):
+    return bytes([n]) * FRAME_SIZE
+
+
+class FakeSource(discord.AudioSource):
+    """指定したフレームを返し終えたら、releaseされるまで待ってからEOFを返すソースです。"""
+
+    def __init__(self, frames: list, *, hold: bool = False):
+        self.frames = list(frames)
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+        self.cleaned_up = False
+
+    def read(self):
+        if self.frames:
+            return self.frames.pop(0)
+        self.release.wait()
+        return b""
+
+    def cleanup(self):
+        self.cleaned_up = True
+        self.release.set()
+
+
+class EndlessSource(discord.AudioSource):
+    def read(self):
+        return frame(1)
+
+
+def test_ring_wraps_around():
+    ring = FrameRing(3, 2)
+    for data in (b"aa", b"bb", b"cc"):
+        assert ring.put(data)
+    assert ring.get() == b"aa"
+    assert ring.put(b"dd")
+
+    assert len(ring) == 3
+    assert [ring.get() for _ in range(3)] == [b"bb", b"cc", b"dd"]
+    assert ring.get() is None
+
+
+def test_ring_when_filled_fires_once_full_or_finished():
+    calls = []
+    ring = FrameRing(2, 2)
+    ring.when_filled(lambda: calls.append("full"))
+    ring.put(b"aa")
+    assert calls == []
+    ring.put(b"bb")
+    assert calls == ["full"]
+
+    ring = FrameRing(4, 2)
+    ring.put(b"aa")
+    ring.when_filled(lambda: calls.append("eof"))
+    ring.finish()
+    assert calls == ["full", "eof"]
+
+    # すでに終わっていればすぐに呼ばれる
+    ring.when_filled(lambda: calls.append("now"))
+    assert calls == ["full", "eof", "now"]
+    assert ring.get() == b"aa"
+    assert ring.get() is None
+
+
+def test_ring_close_wakes_blocked_put():
+    ring = FrameRing(1, 2)
+    ring.put(b"aa")
+    result = []
+    writer = threading.Thread(target=lambda: result.append(ring.put(b"bb")))
+    writer.start()
+
+    ring.close()
+    writer.join(timeout=1)
+
+    assert not writer.is_alive()
+    assert result == [False]
+
+
+@pytest.mark.parametrize("depth", [0, -1])
+def test_ring_rejects_depth_below_one(depth):
+    with pytest.raises(ValueError):
+        FrameRing(depth, 2)
+
+
+def test_buffered_audio_plays_frames_then_eof():
+    audio = BufferedAudio(FakeSource([frame(1), frame(2)]), depth=4)
+    assert asyncio.run(audio.prime())
+
+    assert audio.read() == frame(1)
+    assert audio.read() == frame(2)
+    assert audio.read() == b""
+    assert audio.frames == 2
+    assert audio.underruns == 0
+
+
+def test_buffered_audio_prime_times_out(monkeypatch):
+    monkeypatch.setattr(BufferedAudio, "PRIME_TIMEOUT", 0.05)
+    source = FakeSource([frame(1)], hold=True)
+    audio = BufferedAudio(source, depth=4)
+
+    assert not asyncio.run(audio.prime())
+    source.release.set()
+
+
+def test_buffered_audio_prime_returns_on_cleanup():
+    audio = BufferedAudio(FakeSource([], hold=True), depth=4)
+
+    async def prime_then_cleanup():
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.05, audio.cleanup)
+        return await audio.prime()
+
+    assert asyncio.run(prime_then_cleanup())
+
+
+def test_buffered_audio_returns_silence_on_underrun():
+    source = FakeSource([], hold=True)
+    audio = BufferedAudio(source, depth=4)
+
+    assert audio.read() == BufferedAudio.SILENCE
+    assert audio.underruns == 1
+
+    source.release.set()
+    audio._reader.join(timeout=1)
+    assert audio.read() == b""
+
+
+def test_buffered_audio_returns_silence_after_cleanup():
+    audio = BufferedAudio(FakeSource([frame(1)]), depth=4)
+    assert asyncio.run(audio.prime())
+    audio.cleanup()
+
+    # 閉じる前に読み込んだフレームは出し切り、その後しばらくは無音を返してから終わる
+    assert audio.read() == frame(1)
+    for _ in range(BufferedAudio.RELEASED_SILENCE_FRAMES):
+        assert audio.read() == BufferedAudio.SILENCE
+    assert audio.read() == b""
+    assert audio.frames == 1
+    assert audio.underruns == 0
+
+
+def test_buffered_audio_cleanup_stops_blocked_reader():
+    source = EndlessSource()
+    audio = BufferedAudio(source, depth=1)
+    assert asyncio.run(audio.prime())
+
+    audio.cleanup()
+    audio._reader.join(timeout=1)
+
+    assert not audio._reader.is_alive()
@@ -0,0 +1,50 @@
+from discord_play_music_bot.__main__ import YTDLSource
+
+
+def fmt(format_id: str, abr: float, acodec: str = "opus", protocol: str = "https"):
+    return {
+        "format_id": format_id,
+        "abr": abr,
+        "acodec": acodec,
+        "vcodec": "none",
+        "protocol": protocol,
+        "url": "https://example.com/{}".format(format_id),
+    }
+
+
+FORMATS = [
+    fmt("249", 50),
+    fmt("250", 70),
+    fmt("140", 129, "mp4a.40.2"),
+    fmt("251", 160),
+]
+
+
+def test_picks_smallest_format_meeting_bitrate():
+    assert YTDLSource.select_format(FORMATS, 64000)["format_id"] == "250"
+    assert YTDLSource.select_format(FORMATS, 96000)["format_id"] == "140"
+
+
+def test_opus_wins_a_tie():
+    formats = [fmt("140", 128, "mp4a.40.2"), fmt("251", 128)]
+    assert YTDLSource.select_format(formats, 96000)["format_id"] == "251"
+    assert YTDLSource.select_format(formats[::-1], 384000)["format_id"] == "251"
+
+
+def test_falls_back_to_largest_format():
+    assert YTDLSource.select_format(FORMATS, 384000)["format_id"] == "251"
+
+
+def test_returns_none_without_bitrate_or_candidates():
+    assert YTDLSource.select_format(FORMATS, None) is None
+    assert YTDLSource.select_format([], 64000) is None
+    assert YTDLSource.select_format([dict(fmt("249", 50), abr=None)], 64000) is None
+
+
+def test_skips_manifest_formats():
+    formats = [
+        fmt("dash", 64, protocol="http_dash_segments"),
+        fmt("hls", 64, protocol="m3u8_native"),
+    ]
+    assert YTDLSource.select_format(formats + FORMATS, 64000)["format_id"] == "250"
+    assert YTDLSource.select_format(formats, 64000) is None